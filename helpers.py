@@ -1,6 +1,18 @@
 import collections
+import csv
+import glob
+import hashlib
+import io
+import os
+import re
+import tempfile
+import time
+import uuid
+import zlib
 
 import boto3
+import numpy as np
+from fastwarc.warc import ArchiveIterator
 from pyspark import AccumulatorParam
 
 
@@ -13,14 +25,501 @@ def create_s3_client(AWS_ACCESS_KEY_ID, AWS_SECRET, ENDPOINT_URL):
 
 
 def get_file_stream(s3_client, file_identifier):
-    bucket, key = file_identifier
+    """
+    file_identifier is either (bucket, key) or (bucket, key, start, end), which streams only the byte range
+    [start, end) of the file.
+    """
+    bucket, key, *byte_range = file_identifier
+    kwargs = {}
+    if byte_range:
+        start, end = byte_range
+        kwargs["Range"] = f"bytes={start}-{end - 1}"
     response = s3_client.get_object(
         Bucket=bucket,
-        Key=key
+        Key=key,
+        **kwargs
     )
     return response['Body']._raw_stream
 
 
+GZIP_MEMBER_MAGIC = b"\x1f\x8b\x08"
+
+
+def is_warc_member_start(data, pos):
+    """
+    Checks whether the gzip member starting at data[pos] decompresses into a WARC record header. This rules out byte
+    sequences inside the compressed data that only look like a gzip header.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        return decompressor.decompress(data[pos:], 5) == b"WARC/"
+    except zlib.error:
+        return False
+
+
+def find_warc_member_start(s3_client, file_identifier, offset, size, window=2 ** 20, overlap=2 ** 16):
+    """
+    Returns the offset of the first gzip member at or after offset that starts a WARC record, or size if there is
+    none. The file is scanned in windows of byte range requests. Consecutive windows overlap, so that a candidate at
+    the end of a window is verified again with enough data.
+    """
+    bucket, key = file_identifier[:2]
+    pos = offset
+    while pos < size:
+        end = min(pos + window, size)
+        data = get_file_stream(s3_client, (bucket, key, pos, end)).read()
+        i = data.find(GZIP_MEMBER_MAGIC)
+        while i != -1:
+            if is_warc_member_start(data[:i + overlap], i):
+                return pos + i
+            i = data.find(GZIP_MEMBER_MAGIC, i + 1)
+        if end == size:
+            break
+        pos = max(end - overlap, pos + 1)
+    return size
+
+
+def split_warc_file(s3_client, file_identifier, size, split_bytes):
+    """
+    Splits a multi-member .warc.gz file into file_identifiers of byte ranges of about split_bytes, which start at gzip
+    member boundaries. Every record therefore lies in exactly one split and can be read with get_file_stream() and
+    ArchiveIterator as if the split was a file of its own.
+    """
+    boundaries = [0]
+    for nominal_offset in range(split_bytes, size, split_bytes):
+        boundary = find_warc_member_start(s3_client, file_identifier, max(nominal_offset, boundaries[-1] + 1), size)
+        if boundary >= size:
+            break
+        if boundary > boundaries[-1]:
+            boundaries.append(boundary)
+    if len(boundaries) == 1:
+        return [file_identifier]
+    boundaries.append(size)
+    return [(*file_identifier[:2], start, end) for start, end in zip(boundaries, boundaries[1:])]
+
+
+def split_s3_uri(uri):
+    """
+    Splits an URI of the form s3://bucket/prefix into bucket and prefix.
+    """
+    bucket, _, prefix = uri[len("s3://"):].partition("/")
+    return bucket, prefix.strip("/")
+
+
+def get_shard_name(file_identifier):
+    """
+    Deterministic, filesystem safe shard name for a file_identifier. Retried or speculative tasks of the same input
+    file therefore overwrite the same shard instead of producing duplicates.
+    """
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", "-".join(str(part) for part in file_identifier))
+
+
+def _write_csv_shard(rows, columns, path):
+    n_rows = 0
+    with open(path, mode='w', encoding='utf-8', errors='ignore', newline="\n") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(row)
+            n_rows += 1
+    return n_rows
+
+
+def _write_parquet_shard(rows, columns, path, batch_size=10000):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([(column, pa.string()) for column in columns])
+    n_rows = 0
+    with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                writer.write_table(pa.Table.from_pylist([dict(zip(columns, r)) for r in batch], schema=schema))
+                n_rows += len(batch)
+                batch = []
+        if batch:
+            writer.write_table(pa.Table.from_pylist([dict(zip(columns, r)) for r in batch], schema=schema))
+            n_rows += len(batch)
+    return n_rows
+
+
+def write_shard(rows, columns, output_dir, shard_name, shard_format, s3_credentials=None):
+    """
+    Writes the rows into a single output shard and commits it atomically, so that readers never observe partial
+    shards. output_dir is either a directory on a shared filesystem or an s3://bucket/prefix URI, in which case
+    s3_credentials (AWS_ACCESS_KEY_ID, AWS_SECRET, ENDPOINT_URL) are used for the upload.
+    Returns a manifest dict describing the committed shard.
+    """
+    if shard_format == "csv":
+        write = _write_csv_shard
+    elif shard_format == "parquet":
+        write = _write_parquet_shard
+    else:
+        raise ValueError(f"unknown shard format: {shard_format}")
+    file_name = f"{shard_name}.{shard_format}"
+
+    if output_dir.startswith("s3://"):
+        bucket, prefix = split_s3_uri(output_dir)
+        key = f"{prefix}/{file_name}" if prefix else file_name
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_path = os.path.join(tmp_dir, file_name)
+            n_rows = write(rows, columns, tmp_path)
+            n_bytes = os.path.getsize(tmp_path)
+            # a completed PUT is atomic on S3, the object only becomes visible once the upload has finished
+            create_s3_client(*s3_credentials).upload_file(tmp_path, bucket, key)
+        location = f"s3://{bucket}/{key}"
+    else:
+        location = os.path.join(output_dir, file_name)
+        # write next to the final location, so that os.replace() stays on the same filesystem and is atomic
+        tmp_path = os.path.join(output_dir, f".{file_name}.{uuid.uuid4().hex}.tmp")
+        try:
+            n_rows = write(rows, columns, tmp_path)
+            n_bytes = os.path.getsize(tmp_path)
+            os.replace(tmp_path, location)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    return {"shard": location, "n_rows": n_rows, "n_bytes": n_bytes}
+
+
+def send_frame(outfile, payload):
+    """
+    Writes a length-prefixed frame. An empty payload marks the end of the stream.
+    """
+    outfile.write(len(payload).to_bytes(8, "big"))
+    outfile.write(payload)
+
+
+def recv_frame(infile):
+    """
+    Reads a frame written by send_frame(). Returns None if the connection was closed.
+    """
+    header = infile.read(8)
+    if len(header) < 8:
+        return None
+    length = int.from_bytes(header, "big")
+    payload = infile.read(length)
+    if len(payload) < length:
+        return None
+    return payload
+
+
+def send_credit(conn, n_bytes):
+    """
+    Grants the sending cluster node n_bytes of additional in-flight budget. A credit of 0 acknowledges the end frame.
+    """
+    conn.sendall(n_bytes.to_bytes(8, "big"))
+
+
+def recv_credit(infile):
+    header = infile.read(8)
+    if len(header) < 8:
+        raise ConnectionError("connection to the driver was closed")
+    return int.from_bytes(header, "big")
+
+
+def normalize_url(url, strip_trailing_slashes=True):
+    """
+    Normalizes an URL for the allowlist lookup: the scheme and a leading www. are removed and the host is lowercased.
+    Trailing slashes are removed as well, unless strip_trailing_slashes is False.
+    """
+    url = url.strip()
+    scheme_end = url.find("://")
+    if scheme_end != -1:
+        url = url[scheme_end + 3:]
+    host, sep, rest = url.partition("/")
+    host = host.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    url = host + sep + rest
+    return url.rstrip("/") if strip_trailing_slashes else url
+
+
+def _hash_key(key):
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class UrlMatchIndex:
+    """
+    Compact allowlist index that is built on the driver, shipped to the cluster nodes via broadcast and queried with
+    match(url) for every WARC-Target-URI.
+    Exact URLs and IDs (e.g. tweet status IDs, found in the URL by id_pattern) are stored as a sorted array of 64 bit
+    hashes behind a Bloom filter, so that the vast majority of non-matching URLs is rejected by a few bit tests.
+    Hosts match themselves and all of their subdomains, which is looked up label by label (a hash based trie).
+    Prefixes are kept in one set per prefix length. Their path is matched as written, including a trailing slash,
+    so the prefix http://foo.org/blog/ matches http://foo.org/blog/post but not http://foo.org/blogger.
+    """
+
+    def __init__(self, urls=(), ids=(), hosts=(), prefixes=(), id_pattern=r"/status(?:es)?/(\d+)",
+                 bloom_bits_per_key=10):
+        self.id_pattern = re.compile(id_pattern)
+
+        keys = ["u:" + normalize_url(url) for url in urls] + ["i:" + str(id_).strip() for id_ in ids]
+        self.hashes = np.unique(np.fromiter((_hash_key(key) for key in keys), dtype=np.uint64, count=len(keys)))
+
+        # Bloom filter with k = ln(2) * bits_per_key probes, derived from the 64 bit hash by double hashing
+        self.bloom_n_bits = max(64, int(len(self.hashes) * bloom_bits_per_key))
+        self.bloom_k = max(1, round(0.693 * bloom_bits_per_key))
+        bloom = np.zeros((self.bloom_n_bits + 7) // 8, dtype=np.uint8)
+        h1 = self.hashes & np.uint64(0xffffffff)
+        h2 = (self.hashes >> np.uint64(32)) | np.uint64(1)
+        for i in range(self.bloom_k):
+            positions = (h1 + np.uint64(i) * h2) % np.uint64(self.bloom_n_bits)
+            np.bitwise_or.at(bloom, positions >> np.uint64(3),
+                             np.left_shift(1, positions & np.uint64(7)).astype(np.uint8))
+        self.bloom = bloom.tobytes()
+
+        self.hosts = frozenset(normalize_url(host).partition("/")[0].partition(":")[0] for host in hosts)
+
+        self.prefixes = collections.defaultdict(set)
+        for prefix in prefixes:
+            prefix = normalize_url(prefix, strip_trailing_slashes=False)
+            self.prefixes[len(prefix)].add(prefix)
+        self.prefixes = {length: frozenset(p) for length, p in self.prefixes.items()}
+
+    @classmethod
+    def from_files(cls, urls_file=None, ids_file=None, hosts_file=None, prefixes_file=None, **kwargs):
+        """
+        Builds the index from text files with one entry per line. Empty lines and lines starting with # are skipped.
+        """
+
+        def read(path):
+            if path is None:
+                return []
+            with open(path, encoding="utf-8") as f:
+                return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+        return cls(urls=read(urls_file), ids=read(ids_file), hosts=read(hosts_file), prefixes=read(prefixes_file),
+                   **kwargs)
+
+    def __len__(self):
+        return len(self.hashes) + len(self.hosts) + sum(len(p) for p in self.prefixes.values())
+
+    def _contains_key(self, key):
+        h = _hash_key(key)
+        h1, h2 = h & 0xffffffff, (h >> 32) | 1
+        for i in range(self.bloom_k):
+            position = (h1 + i * h2) % self.bloom_n_bits
+            if not self.bloom[position >> 3] & (1 << (position & 7)):
+                return False
+        h = np.uint64(h)
+        i = np.searchsorted(self.hashes, h)
+        return i < len(self.hashes) and self.hashes[i] == h
+
+    def match(self, url):
+        prefix_url = normalize_url(url, strip_trailing_slashes=False)
+        url = prefix_url.rstrip("/")
+
+        if self.hosts:
+            host = url.partition("/")[0].partition(":")[0]
+            while True:
+                if host in self.hosts:
+                    return True
+                _, dot, host = host.partition(".")
+                if not dot:
+                    break
+
+        for length, prefixes in self.prefixes.items():
+            if prefix_url[:length] in prefixes:
+                return True
+
+        if len(self.hashes):
+            if self._contains_key("u:" + url):
+                return True
+            id_match = self.id_pattern.search(url)
+            if id_match is not None and self._contains_key("i:" + id_match.group(1)):
+                return True
+
+        return False
+
+
+RECORD_CACHE = "<record-cache>"  # bucket name of the file_identifiers (RECORD_CACHE, path) of record cache shards
+
+RECORD_CACHE_COLUMNS = [("file", "string"), ("offset", "int64"), ("record_id", "string"), ("url", "string"),
+                        ("warc_date", "string"), ("http_headers", "string"), ("http_content_type", "string"),
+                        ("http_charset", "string"), ("content_length", "int64"), ("html", "binary")]
+
+
+def _record_cache_schema():
+    import pyarrow as pa
+
+    return pa.schema([(name, getattr(pa, type_)()) for name, type_ in RECORD_CACHE_COLUMNS])
+
+
+class RecordCacheWriter:
+    """
+    Writes the raw HTML and metadata of the matching records of one file_identifier into a zstd compressed Parquet
+    shard of the record cache, keyed by file, record offset and WARC-Record-ID. The shard is committed atomically by
+    commit(), a retried task overwrites the shard of its previous attempt. No shard is written for a file without
+    matching records.
+    The committed records and the files whose shard was aborted are counted in acc_counter, so that the driver can
+    verify the generation before it is committed.
+    """
+
+    def __init__(self, cache_dir, file_identifier, acc_counter, batch_size=1000):
+        self.cache_dir = cache_dir
+        self.acc_counter = acc_counter
+        self.file = f"{file_identifier[0]}/{file_identifier[1]}"
+        # the offsets of a byte range split are relative to its start
+        self.base_offset = file_identifier[2] if len(file_identifier) == 4 else 0
+        self.batch_size = batch_size
+        self.path = os.path.join(cache_dir, f"{get_shard_name(file_identifier)}.parquet")
+        self.tmp_path = os.path.join(cache_dir, f".{get_shard_name(file_identifier)}.{uuid.uuid4().hex}.tmp")
+        self.writer = None
+        self.rows = []
+        self.n_records = 0
+        self.committed = False
+
+    def add(self, record, html_bytes):
+        self.rows.append({
+            "file": self.file,
+            "offset": self.base_offset + record.stream_pos,
+            "record_id": str(record.headers['WARC-Record-ID']),
+            "url": str(record.headers['WARC-Target-URI']),
+            "warc_date": str(record.headers['WARC-Date']),
+            "http_headers": str(record.http_headers),
+            "http_content_type": str(record.http_content_type),
+            "http_charset": record.http_charset,
+            "content_length": record.content_length,
+            "html": html_bytes,
+        })
+        self.n_records += 1
+        if len(self.rows) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self.writer is None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self.writer = pq.ParquetWriter(self.tmp_path, _record_cache_schema(), compression="zstd")
+        self.writer.write_table(pa.Table.from_pylist(self.rows, schema=_record_cache_schema()))
+        self.rows = []
+
+    def commit(self):
+        self.committed = True
+        if not self.n_records:
+            return
+        self._flush()
+        self.writer.close()
+        self.writer = None
+        os.replace(self.tmp_path, self.path)
+        self.acc_counter.add(collections.Counter({"n_cached_records": self.n_records, "n_cache_shards": 1}))
+
+    def abort(self):
+        """
+        Discards the uncommitted shard, e.g. if reading the file failed, and counts the file as failed, so that the
+        generation is not committed with its records missing. Does nothing after commit().
+        """
+        if self.committed:
+            return
+        self.committed = True
+        print(f"record cache: discarding the shard of {self.file}")
+        self.acc_counter.add(collections.Counter({"n_cache_failed_files": 1}))
+        self.rows = []
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+class CachedRecord:
+    """
+    Record replayed from the record cache. Provides the attributes of fastwarc's WarcRecord that are used by the
+    generators, http_headers is the string representation of the original headers.
+    """
+
+    def __init__(self, row):
+        self.headers = {"WARC-Type": "response", "WARC-Target-URI": row["url"], "WARC-Date": row["warc_date"],
+                        "WARC-Record-ID": row["record_id"]}
+        self.http_headers = row["http_headers"]
+        self.http_content_type = row["http_content_type"]
+        self.http_charset = row["http_charset"]
+        self.content_length = row["content_length"]
+        self.stream_pos = row["offset"]
+        self.reader = io.BytesIO(row["html"])
+
+
+def replay_record_cache_shard(path, batch_size=1000):
+    import pyarrow.parquet as pq
+
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+        for row in batch.to_pylist():
+            yield CachedRecord(row)
+
+
+def create_record_cache_generation(cache_dir):
+    """
+    Returns a new, empty directory inside cache_dir for the shards of one cache write run. Shards of earlier or
+    aborted runs are thereby never mixed into the cache of this run.
+    """
+    return os.path.join(cache_dir, f"generation-{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}")
+
+
+def commit_record_cache(cache_dir, generation_dir, n_expected_records):
+    """
+    Writes _index.parquet into generation_dir, which maps the keys (file, offset, record_id) of all cached records to
+    their shard, and then marks the generation as the current one of cache_dir. Returns the number of cached records.
+    Raises a RuntimeError instead if the shards in generation_dir do not hold the n_expected_records committed by the
+    RecordCacheWriters, e.g. because the executors wrote them to a directory that is not shared with the driver.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    os.makedirs(generation_dir, exist_ok=True)
+    index_schema = pa.schema([("file", pa.string()), ("offset", pa.int64()), ("record_id", pa.string()),
+                              ("shard", pa.string())])
+    tables = [index_schema.empty_table()]
+    for path in sorted(glob.glob(os.path.join(generation_dir, "*.parquet"))):
+        if os.path.basename(path) == "_index.parquet":
+            continue
+        table = pq.read_table(path, columns=["file", "offset", "record_id"])
+        tables.append(table.append_column("shard", pa.array([os.path.basename(path)] * len(table), pa.string())))
+    index = pa.concat_tables(tables)
+    if len(index) != n_expected_records:
+        raise RuntimeError(f"record cache generation {generation_dir} holds {len(index)} records, but "
+                           f"{n_expected_records} were cached, is CACHE_DIR on a filesystem shared by all nodes?")
+    tmp_path = os.path.join(generation_dir, "._index.parquet.tmp")
+    pq.write_table(index, tmp_path, compression="zstd")
+    os.replace(tmp_path, os.path.join(generation_dir, "_index.parquet"))
+
+    tmp_path = os.path.join(cache_dir, ".CURRENT.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(os.path.basename(os.path.normpath(generation_dir)))
+    os.replace(tmp_path, os.path.join(cache_dir, "CURRENT"))
+    return len(index)
+
+
+def get_record_cache_shards(cache_dir):
+    """
+    Returns the shards of the current generation of the record cache, as listed in its _index.parquet.
+    """
+    import pyarrow.parquet as pq
+
+    current = os.path.join(cache_dir, "CURRENT")
+    if not os.path.exists(current):
+        raise FileNotFoundError(f"no completed record cache write run in {cache_dir}")
+    with open(current, encoding="utf-8") as f:
+        generation_dir = os.path.join(cache_dir, f.read().strip())
+    shards = pq.read_table(os.path.join(generation_dir, "_index.parquet"), columns=["shard"])["shard"]
+    return sorted(os.path.join(generation_dir, shard) for shard in set(shards.to_pylist()))
+
+
+def iterate_records(s3_client, file_identifier, max_content_length):
+    """
+    Iterates over the WARC records of file_identifier. Shards of the record cache, (RECORD_CACHE, path), are replayed
+    from the cache instead of reading the WARC file from the S3.
+    """
+    if file_identifier[0] == RECORD_CACHE:
+        return replay_record_cache_shard(file_identifier[1])
+    return ArchiveIterator(get_file_stream(s3_client, file_identifier), max_content_length=max_content_length)
+
+
 class CounterAccumulatorParam(AccumulatorParam):
     def zero(self, v):
         return collections.Counter()
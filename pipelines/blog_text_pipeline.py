@@ -10,12 +10,11 @@ import json
 
 
 import tensorflow as tf
-from fastwarc.warc import ArchiveIterator
 from resiliparse.extract.html2text import extract_plain_text
 from resiliparse.parse import detect_encoding
 from resiliparse.parse.html import HTMLTree
 
-from helpers import create_s3_client, get_file_stream
+from helpers import create_s3_client, iterate_records, RecordCacheWriter
 from pipelines.pipeline import Pipeline
 
 
@@ -89,6 +88,8 @@ class BlogPipeline(Pipeline, abc.ABC):
     def get_generator_factory(self):
         
         acc_counter = self.acc_counter
+        url_match_index = self.url_match_index
+        record_cache_dir = self.record_cache_dir
         max_content_length = self.max_content_length
         distributed_filter = self.get_distributed_filter()
         #tokenizer = self.get_tokenizer()
@@ -98,12 +99,13 @@ class BlogPipeline(Pipeline, abc.ABC):
         ENDPOINT_URL = self.ENDPOINT_URL
 
         def generator_factory(file_identifier):
+            record_cache = None
             try:
                 s3_client = create_s3_client(AWS_ACCESS_KEY_ID, AWS_SECRET, ENDPOINT_URL)
                 
-                stream = get_file_stream(s3_client, file_identifier)
+                record_cache = RecordCacheWriter(record_cache_dir, file_identifier, acc_counter) if record_cache_dir else None
                 
-                for record in ArchiveIterator(stream, max_content_length=max_content_length):
+                for record in iterate_records(s3_client, file_identifier, max_content_length):
                     
                     try:
                         
@@ -124,6 +126,9 @@ class BlogPipeline(Pipeline, abc.ABC):
                                 
                                 url = str(record.headers['WARC-Target-URI'])
 
+                                if url_match_index is not None and not url_match_index.value.match(url):
+                                    acc_counter.add(Counter({"n_not_in_allowlist": 1}))
+                                    continue
                                 
                                 if re.findall("blogspot.com/\d{4}/\d{2}/", url) != []:  
                                     
@@ -135,6 +140,9 @@ class BlogPipeline(Pipeline, abc.ABC):
                                     
 
                                     html_bytes = record.reader.read()
+
+                                    if record_cache is not None:
+                                        record_cache.add(record, html_bytes)
                                     
                                     try:
                                         encoding = record.http_charset
@@ -207,11 +215,18 @@ class BlogPipeline(Pipeline, abc.ABC):
                 
                 ## end of for loop
                 
+                if record_cache is not None:
+                    record_cache.commit()
+                
                 acc_counter.add(Counter({"n_finished_warc_files": 1}))
             
             except:
                 yield  "errortext", "errorurl", "errordate", "errorcomment"
                 acc_counter.add(Counter({"n_aws_stream_exception": 1}))
+            
+            finally:
+                if record_cache is not None:
+                    record_cache.abort()  # does nothing after commit()
 
         return generator_factory
 
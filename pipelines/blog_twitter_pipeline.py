@@ -0,0 +1,46 @@
+import resiliparse.parse.lang
+
+from pipelines.multi_target_pipeline import MultiTargetPipeline
+from pipelines.targets import BlogspotTarget, TwitterTarget
+from pipelines.tools.passthrough_model import PassthroughModelPipeline
+
+
+class EnglishBlogspotTarget(BlogspotTarget):
+    def get_distributed_filter(self):
+        def distributed_filter(text):
+            if len(text) < 10:
+                return False
+            return resiliparse.parse.lang.detect_fast(text)[0] == "en"  # only extract english texts
+
+        return distributed_filter
+
+
+class EnglishTwitterTarget(TwitterTarget):
+    def get_distributed_filter(self):
+        def distributed_filter(text):
+            if len(text) < 10:
+                return False
+            return resiliparse.parse.lang.detect_fast(text)[0] == "en"  # only extract english texts
+
+        return distributed_filter
+
+
+class BlogTwitterPipeline(PassthroughModelPipeline, MultiTargetPipeline):
+    """
+    Extracts english blogspot and twitter texts in a single pass over the WARC files.
+    The rows are written to data/blogspot.csv and data/twitter.csv.
+    """
+
+    def __init__(self):
+        out_dir = "data/"
+        max_content_length = 4000000
+        targets = [EnglishBlogspotTarget("blogspot", out_dir), EnglishTwitterTarget("twitter", out_dir)]
+        super().__init__(targets=targets, max_content_length=max_content_length)
+
+    def get_model(self):
+        return None
+
+
+if __name__ == "__main__":
+    p = BlogTwitterPipeline()
+    p.run()
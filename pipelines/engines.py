@@ -0,0 +1,238 @@
+import itertools
+import multiprocessing
+import os
+import queue as queue_module
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from pyspark import SparkContext, SparkConf, cloudpickle
+
+
+def create_engine(config):
+    """
+    Creates the execution engine that is configured in the engine section of the config.
+    """
+    backend = config.get("engine", "BACKEND", fallback="spark")
+    if backend == "spark":
+        return SparkEngine(config)
+    if backend == "processes":
+        return ProcessPoolEngine(config.getint("engine", "N_PROCESSES", fallback=0) or os.cpu_count())
+    raise ValueError(f"unknown engine backend: {backend}")
+
+
+class SparkEngine:
+    """
+    Executes the functions of the pipeline on a Spark cluster, on YARN or with a local master like local[*].
+    The records are streamed to the driver via TCP.
+    """
+
+    streams_to_driver = False
+
+    def __init__(self, config):
+        master = config.get("pyspark", "MASTER", fallback="yarn")
+
+        conf = SparkConf()
+        conf_list = [("spark.executor.instances", str(config["pyspark"]["SPARK_INSTANCES"]))]
+        if master == "yarn" and config.getboolean("pyspark", "enable_prebuilt_dependencies"):
+            # deploy prebuilt dependencies according to
+            # https://spark.apache.org/docs/latest/api/python/user_guide/python_packaging.html#using-virtualenv
+            os.environ['PYSPARK_PYTHON'] = "./environment/bin/python"
+            conf_list.append(("spark.yarn.dist.archives", "/pyspark_venv.tar.gz#environment"))
+        conf.setAll(conf_list)
+        self.sc = SparkContext(master=master, appName="WARC-DL", conf=conf)
+        self.sc.addPyFile("helpers.py")
+
+        self.parallelism = int(config["pyspark"]["SPARK_INSTANCES"]) if master == "yarn" \
+            else self.sc.defaultParallelism
+
+    def accumulator(self, value, accum_param):
+        return self.sc.accumulator(value, accum_param)
+
+    def broadcast(self, value):
+        return self.sc.broadcast(value)
+
+    def map(self, f, items):
+        return self.sc.parallelize(items, len(items)).map(f).collect()
+
+    def flat_map(self, f, items):
+        return self.sc.parallelize(items, len(items)).flatMap(f).collect()
+
+    def foreach(self, f, items):
+        self.sc.parallelize(items, len(items)).foreach(f)
+
+
+_accumulator_ids = itertools.count()
+_worker_accumulators = {}  # accumulators that were deserialized in a worker process, by id
+_worker_function = None
+_worker_queue = None
+
+
+class LocalAccumulator:
+    """
+    Accumulator of the ProcessPoolEngine with the interface of the pyspark Accumulator.
+    Like in pyspark, a copy that is sent to a worker process starts from zero and registers itself, its updates are
+    sent back with every finished task and added to the accumulator of the driver.
+    """
+
+    def __init__(self, value, accum_param, aid=None):
+        self.aid = next(_accumulator_ids) if aid is None else aid
+        self.accum_param = accum_param
+        self._value = value
+
+    def add(self, term):
+        self._value = self.accum_param.addInPlace(self._value, term)
+
+    @property
+    def value(self):
+        return self._value
+
+    def __reduce__(self):
+        return _deserialize_accumulator, (self.aid, self.accum_param)
+
+    def __str__(self):
+        return str(self._value)
+
+
+def _deserialize_accumulator(aid, accum_param):
+    accumulator = LocalAccumulator(accum_param.zero(None), accum_param, aid)
+    _worker_accumulators[aid] = accumulator
+    return accumulator
+
+
+def _pop_accumulator_updates():
+    updates = {}
+    for aid, accumulator in _worker_accumulators.items():
+        updates[aid] = accumulator.value
+        accumulator._value = accumulator.accum_param.zero(None)
+    return updates
+
+
+class LocalBroadcast:
+    """
+    Broadcast variable of the ProcessPoolEngine with the interface of the pyspark Broadcast.
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+
+def _init_worker(pickled_function, queue):
+    global _worker_function, _worker_queue
+    _worker_function = cloudpickle.loads(pickled_function)
+    _worker_queue = queue
+
+
+def _map_task(item):
+    try:
+        return _worker_function(item), _pop_accumulator_updates(), None
+    except Exception:
+        return None, _pop_accumulator_updates(), traceback.format_exc()
+
+
+def _stream_task(item, batch_size=64):
+    error = None
+    batch = []
+    try:
+        for record in _worker_function(item):
+            batch.append(record)
+            if len(batch) >= batch_size:
+                _worker_queue.put(("records", batch))
+                batch = []
+    except Exception:
+        error = traceback.format_exc()
+    if batch:
+        _worker_queue.put(("records", batch))
+    _worker_queue.put(("done", _pop_accumulator_updates(), error))
+
+
+class ProcessPoolEngine:
+    """
+    Executes the functions of the pipeline in a pool of local worker processes instead of a Spark cluster, which
+    starts within seconds and needs no Hadoop/YARN setup. The functions are serialized with cloudpickle, just like
+    with pyspark, so the same generator_factory closures can be used.
+    The records yielded on the workers are passed to the driver via stream() in batches, without TCP connections.
+    """
+
+    streams_to_driver = True
+
+    def __init__(self, n_processes, max_queued_batches=256):
+        self.parallelism = n_processes
+        self.max_queued_batches = max_queued_batches
+        self.accumulators = {}
+        # spawn instead of fork, the driver process is multi-threaded (tensorflow)
+        self.mp_context = multiprocessing.get_context("spawn")
+
+    def accumulator(self, value, accum_param):
+        accumulator = LocalAccumulator(value, accum_param)
+        self.accumulators[accumulator.aid] = accumulator
+        return accumulator
+
+    def broadcast(self, value):
+        return LocalBroadcast(value)
+
+    def _merge_accumulator_updates(self, updates):
+        for aid, update in updates.items():
+            self.accumulators[aid].add(update)
+
+    def _executor(self, f, queue=None):
+        # unlike multiprocessing.Pool, the executor fails all pending tasks with BrokenProcessPool if a worker process
+        # dies (e.g. OOM kill or a crash in the native parsers) instead of silently losing its task
+        return ProcessPoolExecutor(self.parallelism, mp_context=self.mp_context, initializer=_init_worker,
+                                   initargs=(cloudpickle.dumps(f), queue))
+
+    def map(self, f, items):
+        with self._executor(f) as executor:
+            results = list(executor.map(_map_task, items))
+        outputs = []
+        for output, updates, error in results:
+            self._merge_accumulator_updates(updates)
+            if error is not None:
+                raise RuntimeError(f"task failed in worker process:\n{error}")
+            outputs.append(output)
+        return outputs
+
+    def flat_map(self, f, items):
+        return [output for outputs in self.map(f, items) for output in outputs]
+
+    def foreach(self, f, items):
+        self.map(f, items)
+
+    def stream(self, generator_factory, items, poll_interval_s=1.):
+        """
+        Executes generator_factory for every item in the worker processes and yields the records on the driver.
+        The queue between the workers and the driver is bounded, so workers block if the driver falls behind.
+        Raises a RuntimeError if a task fails or a worker process dies.
+        """
+        queue = self.mp_context.Queue(self.max_queued_batches)
+        executor = self._executor(generator_factory, queue)
+        n_done = 0
+        futures = []
+        try:
+            futures.extend(executor.submit(_stream_task, item) for item in items)
+            while n_done < len(items):
+                try:
+                    message = queue.get(timeout=poll_interval_s)
+                except queue_module.Empty:
+                    for future in futures:
+                        if future.done() and future.exception() is not None:
+                            raise RuntimeError("worker process failed") from future.exception()
+                    continue
+                if message[0] == "records":
+                    yield from message[1]
+                    continue
+                _, updates, error = message
+                self._merge_accumulator_updates(updates)
+                if error is not None:
+                    raise RuntimeError(f"task failed in worker process:\n{error}")
+                n_done += 1
+        finally:
+            if n_done < len(items):
+                # shutdown(cancel_futures=True) needs python 3.9, the image ships python 3.8
+                for future in futures:
+                    future.cancel()
+                # remaining workers may block on the full queue forever, so they are terminated instead of awaited.
+                # ProcessPoolExecutor has no public API for this before python 3.14, this relies on its private
+                # _processes dict (pid -> Process), which exists in python 3.8 to 3.13
+                for process in list(executor._processes.values()):
+                    process.terminate()
+            executor.shutdown(wait=True)
@@ -0,0 +1,134 @@
+import collections
+import os
+import tempfile
+import threading
+import time
+
+
+class SpillSegment:
+    """
+    Single spill file of the SpillingQueue, records are appended at the end and read from the front.
+    """
+
+    def __init__(self, spill_dir):
+        self.file = tempfile.TemporaryFile(dir=spill_dir, prefix="warc-dl-spill-")
+        self.write_pos = 0
+        self.read_pos = 0
+        self.count = 0
+
+    def write(self, payload):
+        self.file.seek(self.write_pos)
+        self.file.write(len(payload).to_bytes(8, "big"))
+        self.file.write(payload)
+        self.write_pos = self.file.tell()
+        self.count += 1
+
+    def read(self):
+        self.file.seek(self.read_pos)
+        length = int.from_bytes(self.file.read(8), "big")
+        payload = self.file.read(length)
+        self.read_pos = self.file.tell()
+        self.count -= 1
+        return payload
+
+    def close(self):
+        self.file.close()  # temporary files are deleted on close
+
+
+class SpillingQueue:
+    """
+    FIFO queue for the pickled records that arrive on the driver. Records are kept in memory up to memory_bytes,
+    records beyond that are spilled to local files in spill_dir, so that a slow consumer does not stall the cluster
+    nodes. Once anything is spilled, all following records are appended to the spill as well until it is drained, so
+    the order of the records is kept.
+    The spill is split into segment files of segment_bytes, fully read segments are deleted. Only once the spill
+    files take max_spill_bytes on disk, put() blocks, which stops the credits that are granted to the cluster nodes
+    and thereby throttles them.
+    The time that producers and the consumer spend waiting is recorded in stats.
+    """
+
+    def __init__(self, memory_bytes, spill_dir, max_spill_bytes, segment_bytes=None):
+        self.memory_bytes = memory_bytes
+        self.max_spill_bytes = max_spill_bytes
+        self.segment_bytes = segment_bytes or max(1, min(max_spill_bytes // 8, 2 ** 26))
+        self.spill_dir = spill_dir
+
+        self.cond = threading.Condition()
+        self.memory = collections.deque()
+        self.memory_size = 0
+        self.segments = collections.deque()
+        self.spill_count = 0
+        self.closed = False
+        self.stats = collections.Counter()
+
+    def spill_disk_bytes(self):
+        """
+        Bytes that the spill files take on disk, including read but not yet deleted records.
+        """
+        return sum(segment.write_pos for segment in self.segments)
+
+    def _spill(self, payload):
+        if not self.segments or self.segments[-1].write_pos >= self.segment_bytes:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            self.segments.append(SpillSegment(self.spill_dir))
+        self.segments[-1].write(payload)
+        self.spill_count += 1
+        self.stats["n_spilled_records"] += 1
+        self.stats["spilled_bytes"] += len(payload)
+
+    def _unspill(self):
+        segment = self.segments[0]
+        payload = segment.read()
+        self.spill_count -= 1
+        if not segment.count:
+            # the segment is drained, delete it to reclaim the disk space
+            segment.close()
+            self.segments.popleft()
+        return payload
+
+    def put(self, payload):
+        """
+        Adds a pickled record. Blocks while the memory buffer and the spill files are full.
+        """
+        with self.cond:
+            start = time.perf_counter()
+            # an empty spill always accepts a record, so records larger than the budget cannot block forever
+            while self.spill_count and self.spill_disk_bytes() + len(payload) + 8 > self.max_spill_bytes:
+                self.cond.wait()
+            self.stats["driver_buffer_full_wait_s"] += time.perf_counter() - start
+
+            if not self.spill_count and (self.memory_size + len(payload) <= self.memory_bytes or not self.memory):
+                self.memory.append(payload)
+                self.memory_size += len(payload)
+            else:
+                self._spill(payload)
+            self.cond.notify_all()
+
+    def get(self):
+        """
+        Returns the next pickled record, or None once the queue is closed and drained.
+        """
+        with self.cond:
+            start = time.perf_counter()
+            while not self.memory and not self.spill_count and not self.closed:
+                self.cond.wait()
+            self.stats["driver_consumer_wait_s"] += time.perf_counter() - start
+
+            # records in memory are always older than the spilled ones
+            if self.memory:
+                payload = self.memory.popleft()
+                self.memory_size -= len(payload)
+            elif self.spill_count:
+                payload = self._unspill()
+            else:
+                return None
+            self.cond.notify_all()
+            return payload
+
+    def close(self):
+        """
+        Signals that no more records will be put. Pending records can still be retrieved with get().
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
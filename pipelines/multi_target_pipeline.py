@@ -0,0 +1,191 @@
+import abc
+import csv
+import os
+from collections import Counter
+
+import tensorflow as tf
+from resiliparse.parse import detect_encoding
+from resiliparse.parse.html import HTMLTree
+
+from helpers import create_s3_client, iterate_records, RecordCacheWriter
+from pipelines.pipeline import Pipeline
+
+
+class Target(abc.ABC):
+    """
+    A single extraction target of the MultiTargetPipeline. It consists of a URL predicate that selects the records,
+    an extractor that turns a matching record into a row of strings and an export of these rows on the driver.
+    The default export appends the rows to {out_dir}/{name}.csv.
+    """
+
+    def __init__(self, name, out_dir):
+        self.name = name
+        self.out_dir = out_dir
+        if self.out_dir is not None:
+            os.makedirs(self.out_dir, exist_ok=True)
+
+        self.csv_out = f"{self.out_dir}/{self.name}.csv"
+
+        if not os.path.exists(self.csv_out):
+            with open(self.csv_out, mode='w', encoding='utf-8', newline="\n") as f:
+                writer = csv.writer(f)
+                writer.writerow(self.get_columns())
+
+    @abc.abstractmethod
+    def get_columns(self):
+        """
+        Should return the column names of the rows returned by the extractor.
+        """
+        pass
+
+    @abc.abstractmethod
+    def get_url_predicate(self):
+        """
+        Should return a function url -> bool, which is executed on the pyspark cluster nodes and selects the records
+        of this target. It must not use self.
+        """
+        pass
+
+    @abc.abstractmethod
+    def get_extractor(self):
+        """
+        Should return a function (record, url, tree) -> tuple of strings, which is executed on the pyspark cluster
+        nodes for every record that matches the URL predicate. tree is the already parsed HTMLTree, which is shared
+        between all targets matching the record. The extractor returns None to drop the record. It must not use self.
+        """
+        pass
+
+    def get_distributed_filter(self):
+        """
+        Overridable method that provides a filter on the extracted text, which is executed on the pyspark cluster
+        nodes. The returned distributed_filter must not use self.
+        """
+
+        def distributed_filter(text):
+            return True
+
+        return distributed_filter
+
+    def export(self, *values):
+        row = [value.decode("utf-8") for value in values]
+
+        with open(self.csv_out, "a", encoding="utf-8", errors="ignore", newline="\n") as f:
+            writer = csv.writer(f)
+            writer.writerow(row)
+
+
+class MultiTargetPipeline(Pipeline, abc.ABC):
+    """
+    This pipeline runs several extraction targets in a single pass over the WARC files, so every file is only
+    downloaded and decompressed once. Each record is dispatched to all targets whose URL predicate matches, its HTML
+    is parsed at most once. It streams the target name and the extracted values to the driver, where they are passed
+    to the export of the respective target. Counters are kept per target, prefixed with the target name.
+    """
+
+    def __init__(self, targets, max_content_length):
+        if len({target.name for target in targets}) != len(targets):
+            raise ValueError("target names must be unique")
+        self.targets = {target.name: target for target in targets}
+        self.max_content_length = max_content_length
+        # all targets share one signature, shorter rows are padded with empty strings
+        self.n_values = max(len(target.get_columns()) for target in targets)
+
+        super().__init__()
+
+    def get_signature(self):
+        return (tf.TensorSpec(shape=(), dtype=tf.string),) + \
+               tuple(tf.TensorSpec(shape=(), dtype=tf.string) for _ in range(self.n_values))  # target name, values
+
+    def get_generator_factory(self):
+        acc_counter = self.acc_counter
+        url_match_index = self.url_match_index
+        record_cache_dir = self.record_cache_dir
+        max_content_length = self.max_content_length
+        n_values = self.n_values
+        targets = [(name, target.get_url_predicate(), target.get_extractor()) for name, target in
+                   self.targets.items()]
+
+        AWS_ACCESS_KEY_ID = self.AWS_ACCESS_KEY_ID
+        AWS_SECRET = self.AWS_SECRET
+        ENDPOINT_URL = self.ENDPOINT_URL
+
+        def generator_factory(file_identifier):
+            s3_client = create_s3_client(AWS_ACCESS_KEY_ID, AWS_SECRET, ENDPOINT_URL)
+            record_cache = RecordCacheWriter(record_cache_dir, file_identifier, acc_counter) if record_cache_dir else None
+
+            try:
+                for record in iterate_records(s3_client, file_identifier, max_content_length):
+                    try:
+                        if record.headers is None:
+                            acc_counter.add(Counter({"n_record_headers_none": 1}))
+                            continue
+
+                        if record.http_headers is None:
+                            acc_counter.add(Counter({"n_http_headers_none": 1}))
+                            continue
+
+                        if record.headers['WARC-Type'] != 'response' or record.content_length < 128:
+                            acc_counter.add(Counter({"n_wrong_warc_type": 1}))
+                            continue
+
+                        if not str(record.http_content_type).lower().startswith("text/html"):
+                            acc_counter.add(Counter({"n_wrong_content_type": 1}))
+                            continue
+
+                        url = str(record.headers['WARC-Target-URI'])
+
+                        if url_match_index is not None and not url_match_index.value.match(url):
+                            acc_counter.add(Counter({"n_not_in_allowlist": 1}))
+                            continue
+
+                        matching = [(name, extractor) for name, url_predicate, extractor in targets
+                                    if url_predicate(url)]
+                        if not matching:
+                            acc_counter.add(Counter({"n_no_target_url": 1}))
+                            continue
+
+                        html_bytes = record.reader.read()
+
+                        if record_cache is not None:
+                            record_cache.add(record, html_bytes)
+
+                        try:
+                            encoding = record.http_charset
+                            if encoding is None:
+                                encoding = detect_encoding(html_bytes)
+                            tree = HTMLTree.parse_from_bytes(html_bytes, encoding)
+                        except:
+                            acc_counter.add(Counter({"n_parsing_exception": 1}))
+                            continue
+
+                        for name, extractor in matching:
+                            try:
+                                values = extractor(record, url, tree)
+                            except:
+                                acc_counter.add(Counter({f"{name}_n_extraction_exception": 1}))
+                                continue
+
+                            if values is None:
+                                acc_counter.add(Counter({f"{name}_n_distributed_filter_not_passed": 1}))
+                                continue
+
+                            yield (name, *values) + ("",) * (n_values - len(values))
+                            acc_counter.add(Counter({f"{name}_n_node_results": 1}))
+
+                    except:
+                        acc_counter.add(Counter({"n_unhandled_record_exceptions": 1}))
+                        continue
+
+                if record_cache is not None:
+                    record_cache.commit()
+            finally:
+                if record_cache is not None:
+                    record_cache.abort()  # does nothing after commit()
+
+            acc_counter.add(Counter({"n_finished_warc_files": 1}))
+
+        return generator_factory
+
+    def export(self, name, *values):
+        target = self.targets[name.decode("utf-8")]
+        target.export(*values[:len(target.get_columns())])
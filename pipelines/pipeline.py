@@ -4,15 +4,18 @@ import configparser
 import json
 import os
 import pickle
+import random
 import socket
 import threading
 import time
-from queue import Queue
 
 import tensorflow as tf
-from pyspark import SparkContext, SparkConf
 
-from helpers import create_s3_client, CounterAccumulatorParam
+from helpers import create_s3_client, CounterAccumulatorParam, UrlMatchIndex, split_warc_file, send_frame, recv_frame, \
+    send_credit, recv_credit, RECORD_CACHE, get_record_cache_shards, \
+    create_record_cache_generation, commit_record_cache
+from pipelines.engines import create_engine
+from pipelines.flow_control import SpillingQueue
 
 
 class Pipeline(abc.ABC):
@@ -32,26 +35,38 @@ class Pipeline(abc.ABC):
         self.AWS_SECRET = self.config["s3"]["AWS_SECRET"]
         self.ENDPOINT_URL = self.config["s3"]["ENDPOINT_URL"]
 
-        conf = SparkConf()
-        conf_list = [("spark.executor.instances", str(self.config["pyspark"]["SPARK_INSTANCES"]))]
-        if self.config.getboolean("pyspark", "enable_prebuilt_dependencies"):
-            # deploy prebuilt dependencies according to
-            # https://spark.apache.org/docs/latest/api/python/user_guide/python_packaging.html#using-virtualenv
-            os.environ['PYSPARK_PYTHON'] = "./environment/bin/python"
-            conf_list.append(("spark.yarn.dist.archives", "/pyspark_venv.tar.gz#environment"))
-        conf.setAll(conf_list)
-        self.sc = SparkContext(master="yarn", appName="WARC-DL", conf=conf)
-        self.sc.addPyFile("helpers.py")
+        # optional cache of the matching records: "write" stores them during the run, "replay" reads them from the
+        # cache instead of the WARC files
+        self.CACHE_MODE = self.config.get("cache", "MODE", fallback="off")
+        # the executors do not share the working directory of the driver (e.g. on YARN), so the path is made absolute
+        self.CACHE_DIR = os.path.abspath(self.config.get("cache", "CACHE_DIR", fallback="data/record_cache/"))
+        if self.CACHE_MODE not in ("off", "write", "replay"):
+            raise ValueError(f"unknown cache mode: {self.CACHE_MODE}")
+        # passed to the generators, which store the matching records with a RecordCacheWriter if it is not None.
+        # Every write run gets its own generation directory, which only becomes the current one once it is complete
+        self.record_cache_dir = create_record_cache_generation(self.CACHE_DIR) if self.CACHE_MODE == "write" else None
 
-        self.acc_counter = self.sc.accumulator(collections.Counter(), CounterAccumulatorParam())
+        # executes the functions on the cluster nodes, Spark (YARN or local) or a local process pool
+        self.engine = create_engine(self.config)
+
+        self.acc_counter = self.engine.accumulator(collections.Counter(), CounterAccumulatorParam())
+
+        url_match_index = self.get_url_match_index()
+        self.url_match_index = self.engine.broadcast(url_match_index) if url_match_index is not None else None
 
         self.BATCHSIZE = int(self.config["tensorflow"]["BATCHSIZE"])
 
         #self.model = self.get_model()
 
-        self.q = Queue()  # will keep the file representations of the TCP connections on the driver
+        # credit based flow control between the cluster nodes and the driver, the driver spills to disk if the
+        # consumer falls behind
+        self.MAX_IN_FLIGHT_BYTES = int(self.config.getfloat("flow_control", "MAX_IN_FLIGHT_MB", fallback=8) * 2 ** 20)
+        self.q = SpillingQueue(  # will keep the pickled records received from the cluster nodes
+            memory_bytes=int(self.config.getfloat("flow_control", "MEMORY_BUFFER_MB", fallback=512) * 2 ** 20),
+            spill_dir=self.config.get("flow_control", "SPILL_DIR", fallback="/tmp/warc-dl-spill"),
+            max_spill_bytes=int(self.config.getfloat("flow_control", "MAX_SPILL_GB", fallback=50) * 2 ** 30))
 
-        self.dataset = self.get_interleaved_dataset(1)
+        self.dataset = self.get_dataset()
         #self.dataset = self.dataset.prefetch(tf.data.AUTOTUNE)
         
         # self.dataset = self.get_interleaved_dataset(int(self.config["pyspark"]["SPARK_INSTANCES"]))
@@ -80,6 +95,33 @@ class Pipeline(abc.ABC):
         """
         pass
 
+    def get_url_match_index(self):
+        """
+        Overridable method that returns a UrlMatchIndex, which restricts the extraction to allowlisted URLs, IDs,
+        hosts or prefixes, or None to extract all records. It is broadcast to the cluster nodes, generators should
+        query url_match_index.value.match(url).
+        By default, the index is built from the files given in the [allowlist] section of the config.
+        """
+        files = {name: self.config.get("allowlist", option, fallback=None) or None for name, option in
+                 [("urls_file", "URLS_FILE"), ("ids_file", "IDS_FILE"), ("hosts_file", "HOSTS_FILE"),
+                  ("prefixes_file", "PREFIXES_FILE")]}
+        if not any(files.values()):
+            return None
+        index = UrlMatchIndex.from_files(**files)
+        print("allowlist entries:", len(index))
+        return index
+
+    def get_dataset(self):
+        """
+        Returns the tf.data.Dataset of the values yielded by the generators. With the Spark engine they are streamed
+        from the cluster nodes via TCP, engines that stream to the driver feed them into the dataset directly.
+        """
+        if self.engine.streams_to_driver:
+            return tf.data.Dataset.from_generator(
+                lambda: self.engine.stream(self.get_generator_factory(), self.get_file_splits()),
+                output_signature=self.get_signature())
+        return self.get_interleaved_dataset(1)
+
     def get_interleaved_dataset(self, n_instances):
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.bind(("", 0))
@@ -87,11 +129,23 @@ class Pipeline(abc.ABC):
         self.PORT = s.getsockname()[1]
         s.listen()
 
+        def receiver(conn):
+            # every record that is taken off the connection is granted back to the cluster node as credit
+            with conn, conn.makefile(mode="rb") as infile:
+                while True:
+                    payload = recv_frame(infile)
+                    if payload is None:  # cluster node failed, the task will be retried by spark
+                        return
+                    if not payload:
+                        send_credit(conn, 0)
+                        return
+                    self.q.put(payload)
+                    send_credit(conn, len(payload))
+
         def server():
             while True:
                 conn, _ = s.accept()
-                infile = conn.makefile(mode="rb")
-                self.q.put(infile)
+                threading.Thread(target=receiver, args=(conn,), daemon=True).start()
 
         threading.Thread(target=server, daemon=True).start()
 
@@ -99,16 +153,10 @@ class Pipeline(abc.ABC):
 
         def gen(q):
             while True:
-                f = q.get()
-                if f is None:
-                    q.put(None)
+                payload = q.get()
+                if payload is None:
                     return
-                while True:
-                    try:
-                        yield pickle.load(f)
-                    except EOFError:
-                        f.close()
-                        break
+                yield pickle.loads(payload)
 
         def ds_from_queue(q, signature):
             ds = tf.data.Dataset.from_generator(lambda: gen(q), output_signature=signature)
@@ -133,12 +181,20 @@ class Pipeline(abc.ABC):
         Starts (mostly daemon) threads on the driver, used for controlling the cluster nodes and logging.
         """
 
-        threading.Thread(target=self.feed_cluster_nodes, daemon=True).start()
+        if not self.engine.streams_to_driver:
+            threading.Thread(target=self.feed_cluster_nodes, daemon=True).start()
+        self.start_monitoring_threads()
+
+    def start_monitoring_threads(self):
+        """
+        Starts the daemon threads on the driver that are used for logging and profiling.
+        """
 
         def print_stats():
             while True:
                 time.sleep(10)
                 print("accumulator:", self.acc_counter)
+                print("driver queue:", self.q.stats)
 
         threading.Thread(target=print_stats, daemon=True).start()
 
@@ -157,11 +213,30 @@ class Pipeline(abc.ABC):
         if self.config.getboolean("profiler", "enable_logging"):
             threading.Thread(target=profiler).start()
 
-    def run(self):
+    def run(self, dry_run=False, **dry_run_kwargs):
+        """
+        Runs the pipeline. With dry_run=True, only a sample is processed to estimate the full run, see dry_run().
+        """
+        if dry_run:
+            self.dry_run(**dry_run_kwargs)
+            return
         self.start_threads()
         for data in self.dataset.as_numpy_iterator():
             self.export(*data)
+        self.finish_record_cache()
 
+    def finish_record_cache(self):
+        """
+        Writes the index of the record cache after a run in cache write mode and makes its generation the current one,
+        which is replayed by later runs. Refuses to commit a generation that misses the records of failed files.
+        """
+        if self.CACHE_MODE == "write":
+            counters = self.acc_counter.value
+            if counters["n_cache_failed_files"]:
+                raise RuntimeError(f"not committing record cache generation {self.record_cache_dir}, "
+                                   f"{counters['n_cache_failed_files']} files could not be read")
+            print("cached records:",
+                  commit_record_cache(self.CACHE_DIR, self.record_cache_dir, counters["n_cached_records"]))
 
     @abc.abstractmethod
     def get_generator_factory(self):
@@ -175,31 +250,168 @@ class Pipeline(abc.ABC):
         """
         pass
 
-    def get_bucket_files(self):
+    def get_bucket_files(self, with_sizes=False):
+        """
+        Returns the file_identifiers of all WARC files in the buckets. With with_sizes=True, tuples of file_identifier
+        and file size in bytes are returned.
+        In cache replay mode, the shards of the record cache are returned instead.
+        """
+        if self.CACHE_MODE == "replay":
+            return [((RECORD_CACHE, path), os.path.getsize(path)) if with_sizes else (RECORD_CACHE, path)
+                    for path in get_record_cache_shards(self.CACHE_DIR)]
+
         filenames = []
         for BUCKET_NAME in self.BUCKET_NAMES:
             s3_client = create_s3_client(self.AWS_ACCESS_KEY_ID, self.AWS_SECRET, self.ENDPOINT_URL)
             paginator = s3_client.get_paginator('list_objects_v2')
             pages = paginator.paginate(Bucket=BUCKET_NAME)
-            filenames += [(BUCKET_NAME, obj['Key']) for page in pages for obj in page['Contents'] if
-                          obj['Key'].endswith(".warc.gz")]
+            filenames += [((BUCKET_NAME, obj['Key']), obj['Size']) if with_sizes else (BUCKET_NAME, obj['Key'])
+                          for page in pages for obj in page['Contents'] if obj['Key'].endswith(".warc.gz")]
         return filenames
 
+    def get_file_splits(self):
+        """
+        Returns the file_identifiers that are processed by the cluster nodes. If SPLIT_SIZE_MB is set in the pyspark
+        section of the config, larger files are split at gzip member boundaries into byte ranges of about that size,
+        so that a few large files can still keep all executors busy. The boundaries are searched on the cluster nodes.
+        """
+        split_bytes = int(self.config.getfloat("pyspark", "SPLIT_SIZE_MB", fallback=0) * 2 ** 20)
+        if not split_bytes or self.CACHE_MODE == "replay":
+            return self.get_bucket_files()
+
+        files = self.get_bucket_files(with_sizes=True)
+        AWS_ACCESS_KEY_ID = self.AWS_ACCESS_KEY_ID
+        AWS_SECRET = self.AWS_SECRET
+        ENDPOINT_URL = self.ENDPOINT_URL
+
+        def splitter(file_and_size):
+            file_identifier, size = file_and_size
+            if size <= split_bytes:
+                return [file_identifier]
+            s3_client = create_s3_client(AWS_ACCESS_KEY_ID, AWS_SECRET, ENDPOINT_URL)
+            return split_warc_file(s3_client, file_identifier, size, split_bytes)
+
+        splits = self.engine.flat_map(splitter, files)
+        print(f"split {len(files)} files into {len(splits)} splits")
+        return splits
+
+    def dry_run(self, n_files=10, max_mb_per_file=None, seed=None):
+        """
+        Processes a random sample of n_files WARC files with the real generator from get_generator_factory() (only
+        their first max_mb_per_file MB, if given) and extrapolates the number of yielded records, their pickled size,
+        the bytes read and the wall time of a full run with the parallelism of the engine (SPARK_INSTANCES executors
+        on YARN). The estimates assume that the sample is representative and that every executor runs one task at a
+        time.
+        Nothing is exported. Returns the estimates as dict.
+        """
+        files = self.get_bucket_files(with_sizes=True)
+        total_bytes = sum(size for _, size in files)
+        sample = random.Random(seed).sample(files, min(n_files, len(files)))
+        # the sampled (partial) files must not end up in the record cache
+        record_cache_dir, self.record_cache_dir = self.record_cache_dir, None
+        try:
+            generator_factory = self.get_generator_factory()
+        finally:
+            self.record_cache_dir = record_cache_dir
+        max_bytes = None
+        if max_mb_per_file is not None and self.CACHE_MODE != "replay":  # cache shards can only be replayed whole
+            max_bytes = int(max_mb_per_file * 2 ** 20)
+
+        def measure(file_and_size):
+            file_identifier, size = file_and_size
+            n_bytes = size if max_bytes is None else min(size, max_bytes)
+            if n_bytes < size:
+                file_identifier = (*file_identifier, 0, n_bytes)
+            start = time.perf_counter()
+            n_records, n_record_bytes = 0, 0
+            try:
+                for record in generator_factory(file_identifier):
+                    n_records += 1
+                    n_record_bytes += len(pickle.dumps(record))
+            except Exception:
+                # a byte range usually ends within a gzip member, everything before it is still counted
+                if n_bytes == size:
+                    raise
+            return n_records, n_record_bytes, n_bytes, time.perf_counter() - start
+
+        start = time.perf_counter()
+        results = self.engine.map(measure, sample)
+        sample_wall_s = time.perf_counter() - start
+
+        n_records, n_record_bytes, n_bytes, task_s = (sum(values) for values in zip(*results))
+        scale = total_bytes / max(n_bytes, 1)
+        n_instances = self.engine.parallelism
+        estimates = {
+            "n_files": len(files),
+            "sampled_files": len(sample),
+            "sampled_bytes": n_bytes,
+            "sample_wall_s": sample_wall_s,
+            "n_records": n_records * scale,
+            "record_bytes": n_record_bytes * scale,
+            "bytes_read": total_bytes,
+            "task_s": task_s * scale,
+            "wall_s": task_s * scale / n_instances,
+        }
+
+        print("dry run estimates for the full run:")
+        for name, value in estimates.items():
+            print(f"  {name}: {value:,.0f}")
+
+        # record event counters are named n_<reason>, per target counters (MultiTargetPipeline) <target>_n_<reason>,
+        # shares are computed within each of these groups
+        def group(name):
+            if name.startswith("n_"):
+                return ""
+            if "_n_" in name:
+                return name[:name.index("_n_") + 1]
+            return None
+
+        counters = self.acc_counter.value
+        n_events = collections.Counter()
+        for name, count in counters.items():
+            if group(name) is not None and name != "n_finished_warc_files":
+                n_events[group(name)] += count
+        print("dry run counters (share of the counted record events of the same prefix):")
+        for name, count in counters.most_common():
+            share = ""
+            if group(name) is not None and name != "n_finished_warc_files" and n_events[group(name)]:
+                share = f" ({count / n_events[group(name)]:.2%})"
+            print(f"  {name}: {count:,.0f}{share}")
+
+        return estimates
+
     def feed_cluster_nodes(self):
-        files = self.get_bucket_files()
-        rdd = self.sc.parallelize(files, len(files))
+        files = self.get_file_splits()
         generator_factory = self.get_generator_factory()
         HOST, PORT = self.HOST, self.PORT
+        MAX_IN_FLIGHT_BYTES = self.MAX_IN_FLIGHT_BYTES
+        acc_counter = self.acc_counter
 
         def node_client(generator, HOST, PORT):  # feeds the records yielded by the generator to the driver
+            credit = MAX_IN_FLIGHT_BYTES
+            wait_s = 0.
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
                 s.connect((HOST, PORT))
-                with s.makefile(mode="wb") as outfile:
+                with s.makefile(mode="wb") as outfile, s.makefile(mode="rb") as infile:
                     for record in generator:
-                        pickle.dump(record, outfile)
-
-        rdd.foreach(lambda file_identifier: node_client(generator_factory(file_identifier), HOST, PORT))
-        self.q.put(None)
+                        payload = pickle.dumps(record)
+                        # records larger than the budget are sent once nothing else is in flight
+                        while credit < len(payload) and credit < MAX_IN_FLIGHT_BYTES:
+                            outfile.flush()
+                            start = time.perf_counter()
+                            credit += recv_credit(infile)
+                            wait_s += time.perf_counter() - start
+                        send_frame(outfile, payload)
+                        credit -= len(payload)
+                    send_frame(outfile, b"")
+                    outfile.flush()
+                    # wait until the driver has queued all records, so that the task only finishes afterwards
+                    while recv_credit(infile) != 0:
+                        pass
+            acc_counter.add(collections.Counter({"executor_credit_wait_s": wait_s}))
+
+        self.engine.foreach(lambda file_identifier: node_client(generator_factory(file_identifier), HOST, PORT), files)
+        self.q.close()
 
     def predict(self, model_input, *args):
         """
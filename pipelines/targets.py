@@ -0,0 +1,89 @@
+import re
+
+from dateutil.parser import parse
+from resiliparse.extract.html2text import extract_plain_text
+
+from pipelines.multi_target_pipeline import Target
+
+
+class BlogspotTarget(Target):
+    """
+    Extracts blogspot posts and comment pages, corresponds to the extraction of BlogPipeline.
+    """
+
+    def get_columns(self):
+        return ["text", "url", "date", "comment"]
+
+    def get_url_predicate(self):
+        def url_predicate(url):
+            return re.search(r"blogspot.com/\d{4}/\d{2}/", url) is not None
+
+        return url_predicate
+
+    def get_extractor(self):
+        distributed_filter = self.get_distributed_filter()
+
+        def extractor(record, url, tree):
+            # determine if its a comments html
+            comment = "1" if "show" in url and "Comment" in url else "0"
+
+            # extract date
+            try:
+                p = tree.body.get_elements_by_class_name('date-header')
+                date = p.query_selector('span').text
+                date = parse(date).strftime("%d/%m/%Y")
+            except:
+                try:
+                    date_strings = re.findall(r"blogspot.com/\d{4}/\d{2}/", url)[0].split("/")
+                    date = f"01/{date_strings[2]}/{date_strings[1]}"
+                except:
+                    try:
+                        date = parse(str(record.headers['WARC-Date'])).strftime("%d/%m/%Y")
+                    except:
+                        date = "01/01/1901"
+
+            export_text = extract_plain_text(tree, preserve_formatting=True, main_content=True,
+                                             list_bullets=False, alt_texts=True, links=False,
+                                             form_fields=False, noscript=True)
+
+            if not distributed_filter(export_text):
+                return None
+
+            return export_text, url, date, comment
+
+        return extractor
+
+
+class TwitterTarget(Target):
+    """
+    Extracts twitter status pages, corresponds to the extraction of Twitter_base_Pipeline.
+    """
+
+    def get_columns(self):
+        return ["text", "url", "header", "timestamp"]
+
+    def get_url_predicate(self):
+        def url_predicate(url):
+            return "twitter.com/" in url and "status" in url and "goto" not in url
+
+        return url_predicate
+
+    def get_extractor(self):
+        distributed_filter = self.get_distributed_filter()
+
+        def extractor(record, url, tree):
+            prediction_text = extract_plain_text(tree, preserve_formatting=False,
+                                                 main_content=True, list_bullets=False,
+                                                 alt_texts=False, links=False,
+                                                 form_fields=False, noscript=False)
+
+            if not distributed_filter(prediction_text):
+                return None
+
+            export_text = extract_plain_text(tree, preserve_formatting=True, main_content=True,
+                                             list_bullets=False, alt_texts=True, links=True,
+                                             form_fields=False, noscript=True)
+
+            return export_text, url, str(record.http_headers), str(record.headers['WARC-Date'])
+
+        return extractor
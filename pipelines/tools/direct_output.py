@@ -0,0 +1,93 @@
+import abc
+import json
+import os
+
+from helpers import create_s3_client, get_shard_name, split_s3_uri, write_shard
+from pipelines.pipeline import Pipeline
+
+
+class DirectOutputPipeline(Pipeline, abc.ABC):
+    """
+    This pipeline lets every task write the values yielded by its generator into its own output shard (CSV or
+    Parquet) on a shared filesystem or below an S3 prefix, instead of streaming them to the driver over TCP.
+    The driver only receives the per-shard manifests and the accumulator counters, so the output throughput scales
+    with the number of executors. It can only be used for pipelines without a driver-side model step.
+    """
+
+    def __init__(self, *args, shard_output_dir, shard_format="csv", **kwargs):
+        if shard_format not in ("csv", "parquet"):
+            raise ValueError(f"unknown shard format: {shard_format}")
+        self.shard_output_dir = shard_output_dir
+        self.shard_format = shard_format
+        if not self.shard_output_dir.startswith("s3://"):
+            os.makedirs(self.shard_output_dir, exist_ok=True)
+        super().__init__(*args, **kwargs)
+
+    @abc.abstractmethod
+    def get_shard_columns(self):
+        """
+        Should return the column names of the output shards, in the order of the values yielded by the generator
+        from get_generator_factory().
+        """
+        pass
+
+    def get_dataset(self):
+        # nothing is streamed to the driver, so no server socket and dataset are needed
+        return None
+
+    def run(self, dry_run=False, **dry_run_kwargs):
+        if dry_run:
+            self.dry_run(**dry_run_kwargs)
+            return
+        self.start_monitoring_threads()
+        manifests = self.write_shards()
+        self.write_manifest(manifests)
+        self.finish_record_cache()
+        print("accumulator:", self.acc_counter)
+
+    def write_shards(self):
+        """
+        Executes the generator for every file on the cluster nodes and writes its values into one shard per file.
+        Returns the list of shard manifests.
+        """
+        files = self.get_file_splits()
+        generator_factory = self.get_generator_factory()
+        columns = self.get_shard_columns()
+        shard_output_dir, shard_format = self.shard_output_dir, self.shard_format
+        s3_credentials = (self.AWS_ACCESS_KEY_ID, self.AWS_SECRET, self.ENDPOINT_URL)
+
+        def shard_writer(file_identifier):
+            manifest = write_shard(generator_factory(file_identifier), columns, shard_output_dir,
+                                   get_shard_name(file_identifier), shard_format, s3_credentials)
+            manifest["file_identifier"] = list(file_identifier)
+            return manifest
+
+        return self.engine.map(shard_writer, files)
+
+    def write_manifest(self, manifests):
+        """
+        Writes the manifest of the whole run next to the shards. It is written last, so its presence marks a
+        completed run.
+        """
+        manifest = json.dumps({
+            "format": self.shard_format,
+            "columns": list(self.get_shard_columns()),
+            "n_rows": sum(m["n_rows"] for m in manifests),
+            "n_bytes": sum(m["n_bytes"] for m in manifests),
+            "counters": dict(self.acc_counter.value),
+            "shards": manifests,
+        }, indent=2)
+
+        if self.shard_output_dir.startswith("s3://"):
+            bucket, prefix = split_s3_uri(self.shard_output_dir)
+            s3_client = create_s3_client(self.AWS_ACCESS_KEY_ID, self.AWS_SECRET, self.ENDPOINT_URL)
+            s3_client.put_object(Bucket=bucket, Key=f"{prefix}/_manifest.json" if prefix else "_manifest.json",
+                                 Body=manifest.encode("utf-8"))
+        else:
+            tmp_path = os.path.join(self.shard_output_dir, "._manifest.json.tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(manifest)
+            os.replace(tmp_path, os.path.join(self.shard_output_dir, "_manifest.json"))
+
+    def export(self, *args):
+        return
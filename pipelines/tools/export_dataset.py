@@ -17,9 +17,13 @@ class ExportDatasetPipeline(Pipeline, abc.ABC):
         os.makedirs(self.dataset_export_dir, exist_ok=True)
         super().__init__(*args, **kwargs)
 
-    def run(self):
+    def run(self, dry_run=False, **dry_run_kwargs):
+        if dry_run:
+            self.dry_run(**dry_run_kwargs)
+            return
         self.start_threads()
         tf.data.experimental.save(self.dataset, self.dataset_export_dir)
+        self.finish_record_cache()
 
     def export(self, *args):
         return
@@ -7,12 +7,11 @@ import csv
 
 import numpy as np
 import tensorflow as tf
-from fastwarc.warc import ArchiveIterator
 from resiliparse.extract.html2text import extract_plain_text
 from resiliparse.parse import detect_encoding
 from resiliparse.parse.html import HTMLTree
 
-from helpers import create_s3_client, get_file_stream
+from helpers import create_s3_client, iterate_records, RecordCacheWriter
 from pipelines.pipeline import Pipeline
 
 
@@ -83,6 +82,8 @@ class Twitter_base_Pipeline(Pipeline, abc.ABC):
 
     def get_generator_factory(self):
         acc_counter = self.acc_counter
+        url_match_index = self.url_match_index
+        record_cache_dir = self.record_cache_dir
         
         max_content_length = self.max_content_length
         distributed_filter = self.get_distributed_filter()
@@ -96,86 +97,100 @@ class Twitter_base_Pipeline(Pipeline, abc.ABC):
             
             s3_client = create_s3_client(AWS_ACCESS_KEY_ID, AWS_SECRET, ENDPOINT_URL)
             
-            stream = get_file_stream(s3_client, file_identifier)
+            record_cache = RecordCacheWriter(record_cache_dir, file_identifier, acc_counter) if record_cache_dir else None
             
-            for record in ArchiveIterator(stream, max_content_length=max_content_length):
+            try:
+                for record in iterate_records(s3_client, file_identifier, max_content_length):
                 
-                try:
+                    try:
                     
-                    if record.headers is None:
-                        # empty header
-                        acc_counter.add(Counter({"n_record_headers_none": 1}))
-                        continue
+                        if record.headers is None:
+                            # empty header
+                            acc_counter.add(Counter({"n_record_headers_none": 1}))
+                            continue
                     
-                    if record.http_headers is None:
-                        # no http_header
-                        acc_counter.add(Counter({"n_http_headers_none": 1}))
-                        continue
+                        if record.http_headers is None:
+                            # no http_header
+                            acc_counter.add(Counter({"n_http_headers_none": 1}))
+                            continue
                     
-                    if record.headers['WARC-Type'] == 'response' and record.content_length >= 128:
-                        content_type = str(record.http_content_type).lower()
+                        if record.headers['WARC-Type'] == 'response' and record.content_length >= 128:
+                            content_type = str(record.http_content_type).lower()
                         
-                        if content_type.startswith("text/html"):
+                            if content_type.startswith("text/html"):
                             
-                            url = str(record.headers['WARC-Target-URI'])
+                                url = str(record.headers['WARC-Target-URI'])
                             
-                            warc_time = str(record.headers['WARC-Date'])
+                                warc_time = str(record.headers['WARC-Date'])
+
+                                print(url)
 
-                            print(url)
+                                if url_match_index is not None and not url_match_index.value.match(url):
+                                    acc_counter.add(Counter({"n_not_in_allowlist": 1}))
+                                    continue
                             
-                            if "twitter.com/" in url and "status" in url and not "goto" in url:  #'and re.search("\d{18,19}", url) != None'
-                                ## if twitter in url continue extracting, else do nothing and continue
-                                # continue
+                                if "twitter.com/" in url and "status" in url and not "goto" in url:  #'and re.search("\d{18,19}", url) != None'
+                                    ## if twitter in url continue extracting, else do nothing and continue
+                                    # continue
                             
-                                http_header = str(record.http_headers)
+                                    http_header = str(record.http_headers)
                                 
-                                html_bytes = record.reader.read()
+                                    html_bytes = record.reader.read()
+
+                                    if record_cache is not None:
+                                        record_cache.add(record, html_bytes)
                                 
-                                try:
-                                    encoding = record.http_charset
-                                    if encoding is None:
-                                        encoding = detect_encoding(html_bytes)
-                                    tree = HTMLTree.parse_from_bytes(html_bytes, encoding)
+                                    try:
+                                        encoding = record.http_charset
+                                        if encoding is None:
+                                            encoding = detect_encoding(html_bytes)
+                                        tree = HTMLTree.parse_from_bytes(html_bytes, encoding)
                                 
-                                except:
-                                    acc_counter.add(Counter({"n_parsing_exception": 1}))
-                                    continue
+                                    except:
+                                        acc_counter.add(Counter({"n_parsing_exception": 1}))
+                                        continue
                                 
 
-                                # split the extracted plain text and clean text
-                                prediction_text = extract_plain_text(tree, preserve_formatting=False,
-                                                                    main_content=True, list_bullets=False,# list bullets sind aufzählungszeichen
-                                                                    alt_texts=False, links=False,
-                                                                    form_fields=False, noscript=False)
+                                    # split the extracted plain text and clean text
+                                    prediction_text = extract_plain_text(tree, preserve_formatting=False,
+                                                                        main_content=True, list_bullets=False,# list bullets sind aufzählungszeichen
+                                                                        alt_texts=False, links=False,
+                                                                        form_fields=False, noscript=False)
 
-                                export_text = extract_plain_text(tree, preserve_formatting=True, main_content=True,
-                                                                list_bullets=False, alt_texts=True, links=True,
-                                                                form_fields=False, noscript=True)
+                                    export_text = extract_plain_text(tree, preserve_formatting=True, main_content=True,
+                                                                    list_bullets=False, alt_texts=True, links=True,
+                                                                    form_fields=False, noscript=True)
 
-                                if not distributed_filter(prediction_text):
+                                    if not distributed_filter(prediction_text):
 
-                                    acc_counter.add(Counter({"n_distributed_filter_not_passed": 1}))
-                                    continue
+                                        acc_counter.add(Counter({"n_distributed_filter_not_passed": 1}))
+                                        continue
 
-                                yield  export_text, url, http_header, warc_time #tokenizer(prediction_text),
-                                acc_counter.add(Counter({"n_node_results": 1}))
+                                    yield  export_text, url, http_header, warc_time #tokenizer(prediction_text),
+                                    acc_counter.add(Counter({"n_node_results": 1}))
                             
+                                else:
+                                    # twitter nicht in url enthalten
+                                    acc_counter.add(Counter({"n_no_twitter_url": 1}))
+                                    continue
+
                             else:
-                                # twitter nicht in url enthalten
-                                acc_counter.add(Counter({"n_no_twitter_url": 1}))
+                                acc_counter.add(Counter({"n_wrong_content_type": 1}))
                                 continue
-
+                    
                         else:
-                            acc_counter.add(Counter({"n_wrong_content_type": 1}))
+                            acc_counter.add(Counter({"n_wrong_warc_type": 1}))
                             continue
-                    
-                    else:
-                        acc_counter.add(Counter({"n_wrong_warc_type": 1}))
-                        continue
                 
-                except:
-                    acc_counter.add(Counter({"n_unhandled_record_exceptions": 1}))
-                    continue
+                    except:
+                        acc_counter.add(Counter({"n_unhandled_record_exceptions": 1}))
+                        continue
+            
+                if record_cache is not None:
+                    record_cache.commit()
+            finally:
+                if record_cache is not None:
+                    record_cache.abort()  # does nothing after commit()
             
             acc_counter.add(Counter({"n_finished_warc_files": 1}))
 